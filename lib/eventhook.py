@@ -2,14 +2,21 @@
 class EventHook(object):
     def __init__(self):
         self.__handlers = []
+        # Set when exactly one handler is registered so fire can skip the loop
+        self.__single = None
 
     def addHandler(self, handler):
         self.__handlers.append(handler)
+        self.__updateSingle()
 
     def removeHandler(self, handler):
         self.__handlers.remove(handler)
+        self.__updateSingle()
 
     def fire(self, *args, **kwargs):
+        if self.__single is not None:
+            self.__single(*args, **kwargs)
+            return
         for handler in self.__handlers:
             handler(*args, **kwargs)
 
@@ -17,3 +24,6 @@ class EventHook(object):
         for theHandler in self.__handlers:
             if theHandler.__self__ == inObject:
                 self.removeHandler(theHandler)
+
+    def __updateSingle(self):
+        self.__single = self.__handlers[0] if len(self.__handlers) == 1 else None
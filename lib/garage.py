@@ -1,15 +1,109 @@
+import glob
 import time
+import sched
+import select
 import logging
-import RPi.GPIO as GPIO
+import threading
+from datetime import timedelta
+import gpiod
+from gpiod.line import Bias, Direction, Edge, Value
 from .eventhook import EventHook
 
 
 SHORT_WAIT = .2  # S (200ms)
+STATE_MAX_AGE = 30  # S, re-read the state pin if no edge was seen for this long
+
+# Labels of the gpiochip driving the 40 pin header on the various pi models,
+# pins are numbered as BCM. GPIO_CHIP is used if none of them is found
+HEADER_CHIP_LABELS = ('pinctrl-bcm2835', 'pinctrl-bcm2711', 'pinctrl-rp1')
+GPIO_CHIP = '/dev/gpiochip0'
+CONSUMER = 'garageqtpi'
+_gpio_chip = None
+
+
+# Find the character device of the header chip. Its number differs between
+# models and kernels (e.g. gpiochip4 on a pi 5 with older kernels)
+def _header_chip():
+    global _gpio_chip
+    if _gpio_chip is None:
+        _gpio_chip = GPIO_CHIP
+        for path in sorted(glob.glob('/dev/gpiochip*')):
+            if not gpiod.is_gpiochip_device(path):
+                continue
+            with gpiod.Chip(path) as chip:
+                if chip.get_info().label in HEADER_CHIP_LABELS:
+                    _gpio_chip = path
+                    break
+    return _gpio_chip
+
+
+# Relay pulses are ended from a single background thread so that pressing a
+# button doesn't hold the caller (the mqtt network thread) for SHORT_WAIT
+_pulse_sched = sched.scheduler(time.monotonic, time.sleep)
+_pulse_wakeup = threading.Event()
+_pulse_thread = None
+_pulse_thread_lock = threading.Lock()
+
+
+def _pulse_worker():
+    while True:
+        _pulse_wakeup.wait()
+        _pulse_wakeup.clear()
+        # A failing action must not end the thread, later pulses would
+        # then never be switched off
+        try:
+            _pulse_sched.run()
+        except Exception:
+            logging.exception("Relay pulse action failed")
+
+
+# Run action(*argument) after delay seconds on the pulse thread
+def _schedule(delay, action, argument):
+    global _pulse_thread
+    with _pulse_thread_lock:
+        if _pulse_thread is None or not _pulse_thread.is_alive():
+            _pulse_thread = threading.Thread(target=_pulse_worker, daemon=True)
+            _pulse_thread.start()
+    _pulse_sched.enter(delay, 1, action, argument)
+    _pulse_wakeup.set()
+
+
+# Edges on all input line requests are waited for with a single epoll on
+# their file descriptors, driven by poll_edges() from the main loop
+_edge_epoll = select.epoll()
+_edge_watches = {}  # fd: (line request, callback)
+
+
+# Call callback() from poll_edges() whenever a line of request changes
+def watch_edges(request, callback):
+    _edge_watches[request.fd] = (request, callback)
+    _edge_epoll.register(request.fd, select.EPOLLIN)
+
+
+# Stop dispatching edges of request
+def unwatch_edges(request):
+    if _edge_watches.pop(request.fd, None) is not None:
+        _edge_epoll.unregister(request.fd)
+
+
+# Wait up to timeout seconds (forever if None) for edges and dispatch them.
+# All pending events of a request are consumed before its callback runs once.
+# A failing callback is logged so it can't stop the other doors being watched
+def poll_edges(timeout=None):
+    for fd, _ in _edge_epoll.poll(-1 if timeout is None else timeout):
+        request, callback = _edge_watches[fd]
+        try:
+            request.read_edge_events()
+            callback()
+        except Exception:
+            logging.exception("Handling edge on lines %s failed", request.lines)
+
 """
     The purpose of this class is to map the idea of a garage door to the pinouts on
     the raspberrypi. It provides methods to control the garage door and also provides
-    and event hook to notify you of the state change. It also doesn't maintain any
-    state internally but rather relies directly on reading the pin.
+    and event hook to notify you of the state change. The state is cached
+    after each debounced edge and re-read once it gets older than STATE_MAX_AGE
+    in case an edge was missed.
 """
 
 
@@ -26,31 +120,70 @@ class GarageDoor(object):
         self.mode = int(config.get('state_mode') == 'normally_closed')
         self.invert_relay = bool(config.get('invert_relay'))
         self.check_state_before_command = bool(config.get('check_state_before_command'))
+        # State label for each pin value. IE. If the circuit is normally closed and the
+        # pin reads 1 then the door is closed, and vice versa for normally open
+        self._state_labels = ('open', 'closed') if self.mode else ('closed', 'open')
+        # Relay (on, off) values, high is off if self.invert_relay is True
+        self._on_off = (Value.INACTIVE, Value.ACTIVE) if self.invert_relay else (Value.ACTIVE, Value.INACTIVE)
+        # One lock per relay pin, held for the duration of a pulse
+        self._pulse_locks = {
+            pin: threading.Lock()
+            for pin in (self.relay_opening_pin, self.relay_closing_pin, self.relay_stop_pin)
+            if pin is not None}
 
         # Setup
         self._state = None
         self.onStateChange = EventHook()
+        self._state_lock = threading.Lock()
 
-        # Set relay pin to output, state pin to input, and add a change
-        # listener to the state pin
-        GPIO.setwarnings(False)
-        GPIO.setmode(GPIO.BCM)
-        # Initial output value = high if self.invert_relay is True
-        GPIO.setup(self.relay_opening_pin, GPIO.OUT, initial=self.invert_relay)
-        GPIO.setup(self.relay_closing_pin, GPIO.OUT, initial=self.invert_relay)
-        if self.relay_stop_pin is not None:
-            GPIO.setup(self.relay_stop_pin, GPIO.OUT, initial=self.invert_relay)
+        # Request the relay lines as outputs and the switch lines as inputs.
+        # The kernel debounces the inputs, an edge is only reported once the
+        # line has been stable for SHORT_WAIT
+        self._relays = gpiod.request_lines(
+            _header_chip(),
+            consumer=CONSUMER,
+            config={
+                tuple(self._pulse_locks): gpiod.LineSettings(
+                    direction=Direction.OUTPUT,
+                    output_value=self._on_off[1])})
+        try:
+            self._inputs = gpiod.request_lines(
+                _header_chip(),
+                consumer=CONSUMER,
+                config={
+                    tuple(self._input_pins()): gpiod.LineSettings(
+                        direction=Direction.INPUT,
+                        bias=Bias.PULL_UP,
+                        edge_detection=Edge.BOTH,
+                        debounce_period=timedelta(seconds=SHORT_WAIT))})
+        except BaseException:
+            # Don't hold on to the relays if the switches can't be claimed
+            self._relays.release()
+            self._relays = None
+            raise
+        self._read_state()
+        watch_edges(self._inputs, self.__stateChanged)
 
-        GPIO.setup(self.state_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.add_event_detect(
-            self.state_pin,
-            GPIO.BOTH,
-            callback=self.__stateChanged,
-            bouncetime=300)
+    # Release rpi resources. The edge watch holds a reference to the door, so
+    # it is only garbage collected after release()
+    def release(self):
+        # Construction may have failed before both requests were made
+        inputs = getattr(self, '_inputs', None)
+        if inputs is not None:
+            unwatch_edges(inputs)
+            inputs.release()
+            self._inputs = None
+        relays = getattr(self, '_relays', None)
+        if relays is not None:
+            relays.release()
+            self._relays = None
 
-    # Release rpi resources
     def __del__(self):
-        GPIO.cleanup()
+        self.release()
+
+    # Lines watched for state changes
+    def _input_pins(self):
+        return [self.state_pin]
 
     # These methods all just mimick the button press, they dont differ other than that
     # but for api sake I'll create three methods. Also later we may want to react to state
@@ -68,44 +201,64 @@ class GarageDoor(object):
     def stop(self):
         self.__press_stop()
 
-    # State is a read only property that actually gets its value from the pin
+    # State is a read only property that gets its value from the last
+    # debounced read of the pins
     @property
     def state(self):
-        # Read the mode from the config. Then compare the mode to the current state. IE. If the circuit is normally closed and the state is 1 then the circuit is closed.
-        # and vice versa for normally open
-        state = GPIO.input(self.state_pin)
-        if state == self.mode:
-            return 'closed'
-        else:
-            return 'open'
+        if time.monotonic() - self._state_ts > STATE_MAX_AGE:
+            with self._state_lock:
+                self._read_state()
+        return self._state
+
+    def _read_state(self):
+        self._state = self._state_labels[self._inputs.get_value(self.state_pin).value]
+        self._state_ts = time.monotonic()
+
+    # Mimick a button press by switching the GPIO pin on and off quickly.
+    # The pin is switched off from the pulse thread, a press while the relay
+    # is still on is ignored.
+    def __pulse(self, pin):
+        lock = self._pulse_locks[pin]
+        if not lock.acquire(blocking=False):
+            logging.info("Relay %s already pressed, ignoring", pin)
+            return
+        try:
+            self._relays.set_value(pin, self._on_off[0])
+            _schedule(SHORT_WAIT, self.__release, (pin, lock))
+        except BaseException:
+            self.__release(pin, lock)
+            raise
+
+    # Switch the relay off, retrying once so a single failure can't leave
+    # the button held down
+    def __release(self, pin, lock):
+        try:
+            try:
+                self._relays.set_value(pin, self._on_off[1])
+            except Exception:
+                logging.exception("Switching off relay %s failed, retrying", pin)
+                self._relays.set_value(pin, self._on_off[1])
+        finally:
+            lock.release()
 
-    # Mimick a button press by switching the GPIO pin on and off quickly
     def __press_open(self):
-        GPIO.output(self.relay_opening_pin, not self.invert_relay)
-        time.sleep(SHORT_WAIT)
-        GPIO.output(self.relay_opening_pin, self.invert_relay)
+        self.__pulse(self.relay_opening_pin)
 
     def __press_close(self):
-        GPIO.output(self.relay_closing_pin, not self.invert_relay)
-        time.sleep(SHORT_WAIT)
-        GPIO.output(self.relay_closing_pin, self.invert_relay)
+        self.__pulse(self.relay_closing_pin)
 
     def __press_stop(self):
         if self.relay_stop_pin is not None:
-            GPIO.output(self.relay_stop_pin, not self.invert_relay)
-            time.sleep(SHORT_WAIT)
-            GPIO.output(self.relay_stop_pin, self.invert_relay)
+            self.__pulse(self.relay_stop_pin)
         else:
             logging.info("STOP not setup")
 
-    # Provide an event for when the state pin changes
-
-    def __stateChanged(self, channel):
-        if channel == self.state_pin:
-            # Had some issues getting an accurate value so we are going to wait for a short timeout
-            # after a statechange and then grab the state
-            time.sleep(SHORT_WAIT)
-            self.onStateChange.fire(self.state)
+    # Provide an event for when the switches change. Edges arrive already
+    # debounced by the kernel
+    def __stateChanged(self):
+        with self._state_lock:
+            self._read_state()
+        self.onStateChange.fire(self.state)
 
 #
 # This class inherits from GarageDoor and make use of a second (open) switch
@@ -118,27 +271,24 @@ class GarageDoor(object):
 class TwoSwitchGarageDoor(GarageDoor):
 
     def __init__(self, config):
+        # Add the pin for the open switch, the parent class requests it
+        # along with the state pin
+        self.open_pin = config['open']
         # Use the parent class initialization
         super().__init__(config)
-        # Add the pin for the open switch
-        self.open_pin = config['open']
-        # Add event detect for the open pin
-        GPIO.setup(self.open_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.add_event_detect(
-            self.open_pin,
-            GPIO.BOTH,
-            callback=self.__stateChanged,
-            bouncetime=300)
-
-    # State is a read only property. It's value is determined by the previous
-    # state and what just happened with the switches
-    @property
-    def state(self):
+
+    def _input_pins(self):
+        return [self.state_pin, self.open_pin]
+
+    # The state is determined by the previous state and what just happened
+    # with the switches
+    def _read_state(self):
         # Read the mode from the config. Then compare the mode to the current state. IE. If the circuit is normally closed and the state is 1 then the circuit is closed.
         # and vice versa for normally open
-        closed_state = True if GPIO.input(
-            self.state_pin) == self.mode else False
-        open_state = True if GPIO.input(self.open_pin) == self.mode else False
+        # Both switches are sampled with a single request
+        closed_value, open_value = self._inputs.get_values([self.state_pin, self.open_pin])
+        closed_state = closed_value.value ^ (1 - self.mode)
+        open_state = open_value.value ^ (1 - self.mode)
         if closed_state:
             self._state = 'closed'
         elif open_state:
@@ -147,12 +297,4 @@ class TwoSwitchGarageDoor(GarageDoor):
             self._state = 'opening'
         elif self._state == 'open':
             self._state = 'closing'
-        return self._state
-
-        # Provide an event for when the state pin changes
-    def __stateChanged(self, channel):
-        if channel == self.state_pin or channel == self.open_pin:
-            # Had some issues getting an accurate value so we are going to wait for a short timeout
-            # after a statechange and then grab the state
-            time.sleep(SHORT_WAIT)
-            self.onStateChange.fire(self.state)
+        self._state_ts = time.monotonic()
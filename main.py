@@ -1,17 +1,26 @@
 #!/usr/bin/python3
 import os
-import random
+import hashlib
+import secrets
 import yaml
 import paho.mqtt.client as mqtt
 import paho.mqtt
 import re
+import sched
+import time
 import json
+import functools
 import logging
 import voluptuous as vol
 from voluptuous import Any
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 from lib.garage import GarageDoor
 from lib.garage import TwoSwitchGarageDoor
+from lib.garage import poll_edges
 
 DEFAULT_DISCOVERY = False
 DEFAULT_DISCOVERY_PREFIX = "homeassistant"
@@ -23,15 +32,33 @@ DEFAULT_INVERT_RELAY = False
 DEFAULT_CHECK_STATE_BEFORE_COMMAND = True #Check if the door state is closed before sending opening command (and opened before closing)
 DEFAULT_DEVICE_CLASS = 'garage'
 
+# Anything that isn't a word character is stripped from door ids for mqtt
+ID_CLEAN = re.compile(r'\W+')
+# Names of the validated config caches written next to config.yaml
+CONFIG_CACHE_NAME = re.compile(r'\.config\.[0-9a-f]{64}\.json\Z')
+
+# Identical states published to the same topic within this window are dropped
+DUPLICATE_STATE_WINDOW = .5  # S (500ms)
+# Door states are republished this often as a fallback for missed edges
+STATE_REPUBLISH_INTERVAL = 60  # S
+
 print("GarageQTPi starting")
 discovery_info = {}
 garage_doors = []
+last_published = {}
 
 # Update the mqtt state topic
 
 
 def update_state(value, topic):
-    logging.info("State change triggered: %s -> %s" % (topic, value))
+    now = time.monotonic()
+    previous = last_published.get(topic)
+    if previous is not None and previous[0] == value and now - previous[1] < DUPLICATE_STATE_WINDOW:
+        logging.debug("Dropping duplicate state: %s -> %s", topic, value)
+        return
+    last_published[topic] = (value, now)
+
+    logging.info("State change triggered: %s -> %s", topic, value)
 
     client.publish(topic, value, retain=True)
 
@@ -39,106 +66,156 @@ def update_state(value, topic):
 
 
 def on_connect(client, userdata, flags, rc):
-    logging.info("Connected with result code: %s" % mqtt.connack_string(rc))
+    logging.info("Connected with result code: %s", mqtt.connack_string(rc))
     # notify subscribed clients that we are available
     client.publish(availability_topic, payload_available, retain=True)
 
-    logging.info(
-        "Sent payload: '" +
-        CONFIG['mqtt']['payload_available'] +
-        "' to topic: '" +
-        CONFIG['mqtt']['availability_topic'] +
-        "'")
+    logging.info("Sent payload: %r to topic: %r", payload_available, availability_topic)
 
-    for config in CONFIG['doors']:
-        command_topic = config['command_topic']
-        logging.info("Listening for commands on %s" % command_topic)
-        client.subscribe(command_topic)
+    for door in garage_doors:
+        logging.info("Listening for commands on %s", door.command_topic)
+        client.subscribe(door.command_topic)
 
     # Update each door state in case it changed while disconnected.
+    publish_door_states()
+
+# Publish the current state of every door. door.state is the state cached
+# from the last edge, so a reconnect doesn't read every door's pins
+
+
+def publish_door_states():
     for door in garage_doors:
-        client.publish(door.state_topic, door.state, retain=True)
+        client.publish(door.state_topic, door.state, qos=0, retain=True)
+
+# Periodically republish door states from the main thread
+
+
+def republish_door_states(scheduler):
+    publish_door_states()
+    scheduler.enter(STATE_REPUBLISH_INTERVAL, 1, republish_door_states, (scheduler,))
+
+# The callback for a message on a door's command topic, bound to its door
+# with functools.partial
+
 
-# Execute the specified command for a door
+def on_door_message(client, userdata, msg, door):
+    execute_command(door, msg.payload)
+
+# Execute the specified command (the raw payload bytes) for a door
 
 
 def execute_command(door, command):
-    try:
-        doorName = door.name
-    except BaseException:
-        doorName = door.id
-    logging.info("Executing command %s for door %s" % (command, doorName))
-    if command == "OPEN":
-        door.open()
-    elif command == "CLOSE":
-        door.close()
-    elif command == "STOP":
-        door.stop()
+    logging.info("Executing command %r for door %s", command, door.display_name)
+    action = door.commands.get(command)
+    if action is not None:
+        action()
     else:
-        logging.info("Invalid command: %s" % command)
+        logging.info("Invalid command: %r", command)
 
 
 
-CONFIG_SCHEMA = vol.Schema(
-    {
-    "logging": vol.Schema(
-        {
-            vol.Required("log_level"): Any('DEBUG', 'INFO', 'WARNING','ERROR', 'CRITICAL'),
-            vol.Required("show_timestamp"): bool
-        }),
-    "mqtt": vol.Schema(
-        {
-            vol.Required("host"): str,
-            vol.Required("port"): int,
-            vol.Required("user"): str,
-            vol.Required("password"): str,
-            vol.Optional("discovery", default = DEFAULT_DISCOVERY): Any(bool, None),
-            vol.Optional("discovery_prefix", default = DEFAULT_DISCOVERY_PREFIX): Any(str, None),
-            vol.Optional("availability_topic", default = DEFAULT_AVAILABILITY_TOPIC): Any(str, None),
-            vol.Optional("payload_available", default = DEFAULT_PAYLOAD_AVAILABLE): Any(str,None),
-            vol.Optional("payload_not_available", default = DEFAULT_PAYLOAD_NOT_AVAILABLE ): Any(str, None)
-
-
-        }
-    ),
-    "doors": [vol.Schema(
+# Building the schema is only needed when the config has to be validated,
+# a config that was validated before is loaded from the cache instead
+def config_schema():
+    return vol.Schema(
         {
-            vol.Required("id"): str,
-            vol.Optional("name"): Any(str, None), 
-            vol.Required("relay_opening"): int,
-            vol.Required("relay_closing"): int,
-            vol.Optional("relay_stop", default = None): Any(int,None),
-            vol.Required("state"): int,
-            vol.Optional("open"): int,
-            vol.Optional("state_mode", default = DEFAULT_STATE_MODE): Any(None, 'normally_closed', 'normally_open'),
-            vol.Optional("invert_relay", default = DEFAULT_INVERT_RELAY): bool,
-            vol.Optional("check_state_before_command", default = DEFAULT_CHECK_STATE_BEFORE_COMMAND): bool,
-            vol.Optional("state_topic"): str,
-            vol.Required("command_topic"): str,
-            vol.Optional("device_class", default = DEFAULT_DEVICE_CLASS): str,
-        }
-    )]
-    })
+        "logging": vol.Schema(
+            {
+                vol.Required("log_level"): Any('DEBUG', 'INFO', 'WARNING','ERROR', 'CRITICAL'),
+                vol.Required("show_timestamp"): bool
+            }),
+        "mqtt": vol.Schema(
+            {
+                vol.Required("host"): str,
+                vol.Required("port"): int,
+                vol.Required("user"): str,
+                vol.Required("password"): str,
+                vol.Optional("discovery", default = DEFAULT_DISCOVERY): Any(bool, None),
+                vol.Optional("discovery_prefix", default = DEFAULT_DISCOVERY_PREFIX): Any(str, None),
+                vol.Optional("availability_topic", default = DEFAULT_AVAILABILITY_TOPIC): Any(str, None),
+                vol.Optional("payload_available", default = DEFAULT_PAYLOAD_AVAILABLE): Any(str,None),
+                vol.Optional("payload_not_available", default = DEFAULT_PAYLOAD_NOT_AVAILABLE ): Any(str, None)
+
+
+            }
+        ),
+        "doors": [vol.Schema(
+            {
+                vol.Required("id"): str,
+                vol.Optional("name"): Any(str, None), 
+                vol.Required("relay_opening"): int,
+                vol.Required("relay_closing"): int,
+                vol.Optional("relay_stop", default = None): Any(int,None),
+                vol.Required("state"): int,
+                vol.Optional("open"): int,
+                vol.Optional("state_mode", default = DEFAULT_STATE_MODE): Any(None, 'normally_closed', 'normally_open'),
+                vol.Optional("invert_relay", default = DEFAULT_INVERT_RELAY): bool,
+                vol.Optional("check_state_before_command", default = DEFAULT_CHECK_STATE_BEFORE_COMMAND): bool,
+                vol.Optional("state_topic"): str,
+                vol.Required("command_topic"): str,
+                vol.Optional("device_class", default = DEFAULT_DEVICE_CLASS): str,
+            }
+        )]
+        })
 
 #
 # First look for config.yaml in /config which allows us to map a volume
 # when running in docker.  If not there look in the directory the script is 
 # running from. Using print statements here since logging isn't set up yet.
 try:
-    with open('/config/config.yaml', 'r') as ymlfile:
-        file_CONFIG = yaml.load(ymlfile, Loader=yaml.FullLoader)
+    config_path = '/config/config.yaml'
+    with open(config_path, 'rb') as ymlfile:
+        yaml_bytes = ymlfile.read()
         print("using configuration from /config/config.yaml")
 except FileNotFoundError:
     print("/config/config.yaml not found. Looking in script directory")
     try:
-        with open(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'config.yaml'), 'r') as ymlfile:
-            file_CONFIG = yaml.load(ymlfile, Loader=yaml.FullLoader)
+        config_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'config.yaml')
+        with open(config_path, 'rb') as ymlfile:
+            yaml_bytes = ymlfile.read()
             print("Using config.yaml from script directory")
     except FileNotFoundError:
         print("No config.yaml found. SensorScanner exiting.")
         os._exit(1)
 
-CONFIG = CONFIG_SCHEMA(file_CONFIG)
+#
+# The validated config is cached next to config.yaml, keyed by a hash of the
+# yaml, of this script (which holds the schema and its defaults) and of the
+# voluptuous version (which decides coercion). If the cache can't be read or
+# written we simply validate every time.
+config_hash = hashlib.sha256(yaml_bytes)
+with open(os.path.abspath(__file__), 'rb') as script:
+    config_hash.update(script.read())
+config_hash.update(vol.__version__.encode())
+# The cache holds the mqtt password so it is only readable by its owner, and
+# caches of earlier configs are removed when a new one is written.
+config_cache_dir = os.path.dirname(config_path)
+config_cache = os.path.join(
+    config_cache_dir,
+    ".config.%s.json" % config_hash.hexdigest())
+try:
+    with open(config_cache, 'r') as cachefile:
+        CONFIG = json.load(cachefile)
+        config_cached = True
+except (OSError, ValueError):
+    CONFIG = config_schema()(yaml.load(yaml_bytes, Loader=YamlLoader))
+    config_cached = False
+    config_cache_tmp = "%s.%d.tmp" % (config_cache, os.getpid())
+    try:
+        fd = os.open(config_cache_tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as cachefile:
+            json.dump(CONFIG, cachefile)
+        os.replace(config_cache_tmp, config_cache)
+        for name in os.listdir(config_cache_dir):
+            stale_cache = os.path.join(config_cache_dir, name)
+            if CONFIG_CACHE_NAME.match(name) and stale_cache != config_cache:
+                os.remove(stale_cache)
+    except OSError:
+        try:
+            os.remove(config_cache_tmp)
+        except OSError:
+            pass
+
 #
 # setup logging and then log sucessful configuration validation
 #
@@ -147,7 +224,10 @@ if CONFIG['logging']['show_timestamp']:
 else:
     logging.basicConfig(level=CONFIG["logging"]["log_level"])
 
-logging.info ("Config sucessfully validated against schema")
+if config_cached:
+    logging.info ("Using config previously validated against schema from %s", config_cache)
+else:
+    logging.info ("Config sucessfully validated against schema")
 logging.info (json.dumps(CONFIG, indent = 4))
 
 ### SETUP MQTT ###
@@ -186,8 +266,8 @@ else:
     payload_not_available = CONFIG['mqtt']['payload_not_available']
 
 # client = mqtt.Client(client_id="MQTTGarageDoor_" + binascii.b2a_hex(os.urandom(6)), clean_session=True, userdata=None, protocol=4)
-client = mqtt.Client(client_id="MQTTGarageDoor_{:6s}".format(str(random.randint(
-    0, 999999))), clean_session=True, userdata=None, protocol=mqtt.MQTTv311)
+client = mqtt.Client(client_id="MQTTGarageDoor_" + secrets.token_hex(3),
+                     clean_session=True, userdata=None, protocol=mqtt.MQTTv311)
 
 client.on_connect = on_connect
 
@@ -197,12 +277,7 @@ client.username_pw_set(user, password=password)
 # set a last will message so the broker will notify connected clients when
 # we are not available
 client.will_set(availability_topic, payload_not_available, retain=True)
-logging.info(
-    "Set last will message: '" +
-    payload_not_available +
-    "' for topic: '" +
-    availability_topic +
-    "'")
+logging.info("Set last will message: %r for topic: %r", payload_not_available, availability_topic)
 
 
 client.connect(host, port, 60)
@@ -222,7 +297,7 @@ if __name__ == "__main__":
             doorCfg['name'] = doorCfg['id']
 
         # Sanitize id value for mqtt
-        doorCfg['id'] = re.sub(r'\W+', '', re.sub(r'\s', ' ', doorCfg['id']))
+        doorCfg['id'] = ID_CLEAN.sub('', doorCfg['id'])
 
         if discovery is True:
             base_topic = discovery_prefix + "/cover/" + doorCfg['id']
@@ -244,19 +319,17 @@ if __name__ == "__main__":
         else:
             door = GarageDoor(doorCfg)
 
-        # Callback per door that passes a reference to the door
-        def on_message(client, userdata, msg, door=door):
-            execute_command(door, msg.payload.decode("utf-8"))
-
-        # Callback per door that passes the doors state topic
-        def on_state_change(value, topic=state_topic):
-            update_state(value, topic)
+        door.display_name = doorCfg['name']
+        door.commands = {b"OPEN": door.open, b"CLOSE": door.close, b"STOP": door.stop}
 
-        client.message_callback_add(command_topic, on_message)
+        # Callback per door that passes a reference to the door
+        client.message_callback_add(
+            command_topic, functools.partial(on_door_message, door=door))
 
+        # Callback per door that passes the doors state topic.
         # You can add additional listeners here and they will all be executed
         # when the door state changes
-        door.onStateChange.addHandler(on_state_change)
+        door.onStateChange.addHandler(functools.partial(update_state, topic=state_topic))
 
         # Publish initial door state
         client.publish(state_topic, door.state, retain=True)
@@ -285,11 +358,20 @@ if __name__ == "__main__":
                 retain=True)
 
             logging.info(
-                "Sent audodiscovery config: " +
+                "Sent audodiscovery config: %s",
                 json.dumps(
                     discovery_info,
                     indent=4))
-            logging.info("to topic: " + config_topic)
+            logging.info("to topic: %s", config_topic)
 
-    # Main loop
-    client.loop_forever()
+    # Main loop. The mqtt network loop runs in its own thread, the main
+    # thread waits for door switch edges until the next state republish is due
+    client.loop_start()
+    watchdog = sched.scheduler(time.monotonic, time.sleep)
+    watchdog.enter(STATE_REPUBLISH_INTERVAL, 1, republish_door_states, (watchdog,))
+    try:
+        while True:
+            poll_edges(watchdog.run(blocking=False))
+    finally:
+        for door in garage_doors:
+            door.release()